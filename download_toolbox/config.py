@@ -1,10 +1,17 @@
+import hashlib
 import logging
+import mmap
 import os
 
 from collections import UserDict
 
 import orjson
 
+from download_toolbox.utils import atomic_write
+
+# Below this size reading straight into bytes is cheaper than setting up a mapping
+MMAP_THRESHOLD = 64 * 1024
+
 
 class ConfigurationError(RuntimeError):
     pass
@@ -22,16 +29,33 @@ class Configuration(UserDict):
         self._identifier = identifier
         self._history = []
         self._config_type = config_type
+        self._last_digest = None
+        self._output_file = self._resolve_output_file()
 
         self._load_existing()
 
     def _load_existing(self):
-        if os.path.exists(self.output_file):
-            logging.info("Loading configuration {}".format(self.output_file))
-            with open(self.output_file, "r") as fh:
-                data = fh.read()
-            obj = orjson.loads(data)
+        try:
+            with open(self.output_file, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size < MMAP_THRESHOLD:
+                    buffer = fh.read()
+                    obj = orjson.loads(buffer)
+                    self._last_digest = self._digest(buffer)
+                else:
+                    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buffer:
+                        obj = orjson.loads(buffer)
+                        self._last_digest = self._digest(buffer)
+        except FileNotFoundError:
+            return
+
+        logging.info("Loading configuration %s", self.output_file)
+        self._history.extend(obj.get("history", ()))
+
+        # orjson hands back a fresh dict, so adopt it outright unless we need to merge
+        if len(self.data) > 0:
             self.data.update(obj["data"])
+        else:
+            self.data = obj["data"]
 
     def render(self,
                owner,
@@ -48,14 +72,34 @@ class Configuration(UserDict):
             "implementation": implementation if implementation is not None else owner.__class__.__name__,
         }
 
-        logging.info("Writing configuration to {}".format(self.output_file))
-        logging.debug(configuration)
-
-        str_data = orjson.dumps(configuration)
-        with open(self.output_file, "w") as fh:
-            fh.write(str_data.decode())
+        # orjson natively handles numpy types, dates and dataclasses; note it only
+        # supports OPT_INDENT_2 should pretty-printing ever be wanted
+        data = orjson.dumps(configuration,
+                            option=orjson.OPT_SERIALIZE_NUMPY |
+                            orjson.OPT_NAIVE_UTC |
+                            orjson.OPT_APPEND_NEWLINE)
+        digest = self._digest(data)
+
+        try:
+            unchanged = digest == self._last_digest and os.path.getsize(self.output_file) == len(data)
+        except FileNotFoundError:
+            unchanged = False
+
+        if unchanged:
+            logging.info("Configuration %s is unchanged, not rewriting", self.output_file)
+        else:
+            logging.info("Writing configuration to %s", self.output_file)
+            logging.debug(configuration)
+
+            with atomic_write(self.output_file) as fh:
+                fh.write(data)
+            self._last_digest = digest
         return self.output_file
 
+    @staticmethod
+    def _digest(data: object) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
     @property
     def directory(self):
         return self._directory
@@ -65,6 +109,8 @@ class Configuration(UserDict):
         if not os.path.isdir(directory):
             raise RuntimeError("Path {} is invalid, needs to be a directory".format(directory))
         self._directory = directory
+        self._output_file = self._resolve_output_file()
+        self._last_digest = None
 
     @property
     def identifier(self):
@@ -72,4 +118,7 @@ class Configuration(UserDict):
 
     @property
     def output_file(self):
-        return os.path.join(self.directory, "{}.{}.json".format(self._config_type, self.identifier))
+        return self._output_file
+
+    def _resolve_output_file(self):
+        return os.path.join(self._directory, "{}.{}.json".format(self._config_type, self._identifier))
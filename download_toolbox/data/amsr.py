@@ -2,11 +2,12 @@ import logging
 import os
 
 import datetime as dt
+from functools import lru_cache
 
 from download_toolbox.dataset import DatasetConfig, DataSetError
 from download_toolbox.cli import download_args
 from download_toolbox.download import ThreadedDownloader, DownloaderError
-from download_toolbox.utils import HTTPClient
+from download_toolbox.utils import HTTPClient, stat_or_none
 from download_toolbox.location import Location
 from download_toolbox.time import Frequency
 
@@ -14,6 +15,35 @@ from download_toolbox.time import Frequency
 var_remove_list = ["polar_stereographic", "land"]
 
 
+@lru_cache(maxsize=None)
+def resolution_token(resolution: float) -> str:
+    """Naming token for a product resolution, as used in identifiers and URLs (e.g. 6.25 -> 6250)
+
+    :param resolution:
+    :return:
+    """
+    return "{:1.3f}".format(resolution).replace(".", "")
+
+
+@lru_cache(maxsize=8)
+def amsr_http_client(hemi_str: str,
+                     res_str: str,
+                     max_threads: int,
+                     conditional: bool = False) -> HTTPClient:
+    """Shared client per product and thread count, so that downloaders reuse the same connection pool
+
+    :param hemi_str:
+    :param res_str:
+    :param max_threads: the number of threads sharing the client, which sizes its connection pool
+    :param conditional: revalidate existing files rather than skipping them
+    :return:
+    """
+    return HTTPClient("https://data.seaice.uni-bremen.de",
+                      source_base="amsr2/asi_daygrid_swath/{}{}/netcdf".format(hemi_str, res_str),
+                      conditional=conditional,
+                      pool_maxsize=max_threads)
+
+
 class AMSRDatasetConfig(DatasetConfig):
     def __init__(self,
                  identifier=None,
@@ -28,7 +58,7 @@ class AMSRDatasetConfig(DatasetConfig):
 
         self._resolution = resolution
 
-        super().__init__(identifier="amsr2_{:1.3f}".format(resolution).replace(".", "")
+        super().__init__(identifier="amsr2_{}".format(resolution_token(resolution))
                          if identifier is None else identifier,
                          var_names=["siconca"] if var_names is None else var_names,
                          levels=[None] if levels is None else levels,
@@ -48,10 +78,14 @@ class AMSRDownloader(ThreadedDownloader):
     We use the following for HTTPS downloads:
         - https://data.seaice.uni-bremen.de
 
+    With revalidate, files already on disk are checked against the server with conditional
+    requests and only fetched again if they have changed, rather than being skipped.
+
     """
     def __init__(self,
                  dataset: AMSRDatasetConfig,
                  *args,
+                 revalidate: bool = False,
                  start_date: object,
                  **kwargs):
         amsr2_start = dt.date(2012, 7, 2)
@@ -60,38 +94,44 @@ class AMSRDownloader(ThreadedDownloader):
         if start_date < amsr2_start:
             raise DownloaderError("AMSR2 only exists past {}".format(amsr2_start))
         self._hemi_str = "s" if dataset.location.south else "n"
-        self._http_client = HTTPClient("https://data.seaice.uni-bremen.de",
-                                       source_base="amsr2/asi_daygrid_swath/{}{}/netcdf".format(
-                                           self._hemi_str, "{:1.3f}".format(dataset.resolution).replace(".", "")))
+        self._res_str = resolution_token(dataset.resolution)
+        self._file_prefix = "asi-AMSR2-{}{}-".format(self._hemi_str, self._res_str)
+        self._revalidate = revalidate
 
         super().__init__(dataset,
                          *args,
                          start_date=start_date,
                          **kwargs)
 
+        self._http_client = amsr_http_client(self._hemi_str,
+                                             self._res_str,
+                                             self.max_threads,
+                                             conditional=revalidate)
+
     def _single_download(self,
                          var_config: object,
                          req_dates: object):
 
         files_downloaded = []
+        var_root = var_config.root_path
 
-        for file_date in req_dates:
-            year_dir = str(file_date.year)
-            date_str = file_date.strftime("%Y%m%d")
+        for year_dir in {str(file_date.year) for file_date in req_dates}:
+            os.makedirs(os.path.join(var_root, year_dir), exist_ok=True)
 
-            file_in_question = "{}/asi-AMSR2-{}{}-{}-v5.4.nc".\
-                               format(year_dir, self._hemi_str, "{:1.3f}".
-                                      format(self.dataset.resolution).
-                                      replace(".", ""), date_str)
-            destination_path = os.path.join(var_config.root_path, file_in_question)
+        for file_date in req_dates:
+            # Year directories exist already, so plain concatenation is enough here
+            file_in_question = "{}/{}{}-v5.4.nc".format(file_date.year, self._file_prefix,
+                                                        file_date.strftime("%Y%m%d"))
+            destination_path = "{}/{}".format(var_root, file_in_question)
 
-            if not os.path.exists(os.path.dirname(destination_path)):
-                os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            destination_stat = stat_or_none(destination_path)
 
-            if not os.path.exists(destination_path):
+            # Empty files are the remnants of failed writes, so we refetch them
+            if destination_stat is None or destination_stat.st_size == 0 or self._revalidate:
                 try:
                     logging.info("Downloading {}".format(destination_path))
-                    self._http_client.single_request(file_in_question, destination_path)
+                    if not self._http_client.single_request(file_in_question, destination_path):
+                        logging.debug("{} is unchanged".format(destination_path))
                     files_downloaded.append(destination_path)
                 except DownloaderError as e:
                     logging.warning("Failed to download {}: {}".format(destination_path, e))
@@ -111,6 +151,11 @@ def main():
                                  type=float,
                                  choices=[3.125, 6.25],
                                  default=6.25
+                             )),
+                             (["--revalidate"], dict(
+                                 action="store_true",
+                                 default=False,
+                                 help="Check existing files against the server and refetch any that have changed"
                              ))])
 
     logging.info("AMSR-SIC Data Downloading")
@@ -130,13 +175,15 @@ def main():
     sic = AMSRDownloader(
         dataset,
         max_threads=args.workers,
+        revalidate=args.revalidate,
         start_date=args.start_date,
         end_date=args.end_date,
     )
     sic.download()
+    missing_dates = frozenset(sic.missing_dates)
     dataset.save_data_for_config(
         rename_var_list=dict(z="siconca"),
         source_files=sic.files_downloaded,
-        time_dim_values=[date for date in sic.dates if date not in sic.missing_dates],
+        time_dim_values=[date for date in sic.dates if date not in missing_dates],
         var_filter_list=var_remove_list
     )
@@ -1,21 +1,124 @@
 import datetime as dt
 import logging
-import requests
-import requests.adapters
 import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
 
 import cdsapi as cds
+import netCDF4
+import pandas as pd
+import requests
 import xarray as xr
+from urllib3.util.retry import Retry
 
 from download_toolbox.dataset import DatasetConfig
 from download_toolbox.cli import download_args
 from download_toolbox.download import ThreadedDownloader, DownloaderError
 from download_toolbox.location import Location
 from download_toolbox.time import Frequency
+from download_toolbox.utils import SocketOptionsAdapter, atomic_path, atomic_write, check_content_length, stat_or_none
+
+# Opt-in storage precision per variable prefix: packed int16 where the physical range allows,
+# otherwise netCDF bit-shaving to a number of significant decimal places
+quant_specs = {
+    'tas': dict(dtype="int16", scale_factor=0.01, add_offset=273.15, _FillValue=-32767),
+    'ta': dict(dtype="int16", scale_factor=0.01, add_offset=273.15, _FillValue=-32767),
+    'tos': dict(dtype="int16", scale_factor=0.01, add_offset=273.15, _FillValue=-32767),
+    'uas': dict(dtype="int16", scale_factor=0.01, add_offset=0., _FillValue=-32767),
+    'vas': dict(dtype="int16", scale_factor=0.01, add_offset=0., _FillValue=-32767),
+    'psl': dict(least_significant_digit=0),
+    'zg': dict(least_significant_digit=1),
+    'hus': dict(least_significant_digit=6),
+    'rlds': dict(least_significant_digit=0),
+    'rsds': dict(least_significant_digit=0),
+}
+
+# Encoding keys describing packed storage, carried over from source files when rewriting
+packing_keys = ("dtype", "scale_factor", "add_offset", "_FillValue", "missing_value")
+
+# Zero padded request values, formatted once rather than per request
+request_days = tuple("{:02d}".format(d) for d in range(1, 32))
+request_months = tuple("{:02d}".format(m) for m in range(1, 13))
+
+
+def pooled_session(pool_size: int,
+                   max_retries: object = 0) -> requests.Session:
+    """Session with the socket tuned adapter mounted, keeping up to pool_size connections alive
+
+    :param pool_size:
+    :param max_retries: passed to the adapter, either a count or a urllib3 Retry
+    :return:
+    """
+    logging.debug("Mounting adapter with a connection limit of {}".format(pool_size))
+    session = requests.Session()
+    adapter = SocketOptionsAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=max_retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def cds_session(pool_size: int) -> requests.Session:
+    """Session shared by every CDS API client in the process, for a given connection pool size
+
+    No retries are configured, cdsapi retries failed and rate limited calls itself with far longer
+    back off than urllib3 would, and doesn't handle the RetryError raised when urllib3 gives up
+
+    :param pool_size:
+    :return:
+    """
+    return pooled_session(pool_size)
+
+
+@lru_cache(maxsize=None)
+def result_session(pool_size: int) -> requests.Session:
+    """Session for fetching completed CDS results, which retries server errors and rate limiting
+
+    :param pool_size:
+    :return:
+    """
+    return pooled_session(pool_size,
+                          max_retries=Retry(total=5,
+                                            backoff_factor=0.5,
+                                            status_forcelist=(429, 500, 502, 503, 504)))
+
+
+@contextmanager
+def open_time_chunked(path: os.PathLike):
+    """Opens a netCDF file lazily in chunks of up to a day of hours, matching the output encoding
+
+    Files from the newer CDS name their time dimension valid_time, so the chunks are built against
+    whichever time dimension the file has, so that a rewrite streams chunk by chunk
+
+    :param path:
+    """
+    with xr.open_dataset(path) as ds:
+        time_dim = "valid_time" if "valid_time" in ds.dims else "time"
+        yield ds.chunk({time_dim: 24}) if time_dim in ds.dims else ds
+
+
+# Directories already known to exist in this process, saving a makedirs call per download
+_ensured_dirs = set()
+
+
+def _ensure_dir(path: str):
+    """Creates path if this process hasn't already ensured it exists
+
+    :param path:
+    """
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
 
 
 class ERA5DatasetConfig(DatasetConfig):
-    CDI_MAP = {
+    CDI_MAP = MappingProxyType({
         'tas': '2m_temperature',
         'ta': 'temperature',  # 500
         'tos': 'sea_surface_temperature',
@@ -26,7 +129,7 @@ class ERA5DatasetConfig(DatasetConfig):
         'rsds': 'surface_solar_radiation_downwards',
         'uas': '10m_u_component_of_wind',
         'vas': '10m_v_component_of_wind',
-    }
+    })
 
     def __init__(self,
                  identifier: str = None,
@@ -36,9 +139,8 @@ class ERA5DatasetConfig(DatasetConfig):
                          if identifier is None else identifier,
                          **kwargs)
 
-        self._cdi_map = ERA5DatasetConfig.CDI_MAP
-        if cdi_map is not None:
-            self._cdi_map.update(cdi_map)
+        # Merged into a plain dict per instance, which leaves the defaults untouched and keeps the config serialisable
+        self._cdi_map = {**ERA5DatasetConfig.CDI_MAP, **(cdi_map if cdi_map is not None else {})}
 
     @property
     def cdi_map(self):
@@ -49,14 +151,26 @@ class ERA5Downloader(ThreadedDownloader):
     def __init__(self,
                  dataset: ERA5DatasetConfig,
                  *args,
+                 compress: int = None,
+                 compression: str = "zlib",
+                 force_redownload: bool = False,
+                 quantise: bool = False,
                  use_toolbox: bool = False,
                  show_progress: bool = False,
                  start_date: object,
                  **kwargs):
         era5_start = dt.date(1940, 1, 1)
-        self.client = cds.Client(progress=show_progress)
+        self._show_progress = show_progress
+        self._thread_clients = threading.local()
         logging.getLogger("cdsapi").setLevel(logging.WARNING)
 
+        self._compress = compress
+        self._compression = compression
+        if compression == "zstd" and not getattr(netCDF4, "__has_zstandard_support__", False):
+            logging.warning("netCDF4 has no Zstandard support in this environment, falling back to zlib")
+            self._compression = "zlib"
+        self._force_redownload = force_redownload
+        self._quantise = quantise
         self._use_toolbox = use_toolbox
 
         if start_date < era5_start:
@@ -72,57 +186,109 @@ class ERA5Downloader(ThreadedDownloader):
                          start_date=start_date,
                          **kwargs)
 
-        self.download_method = self._single_api_download
+        self.download_method = self._batched_api_download
         if use_toolbox:
             self.download_method = self._single_toolbox_download
 
-        if self.max_threads > 10:
-            logging.info("Upping connection limit for max_threads > 10")
-            adapter = requests.adapters.HTTPAdapter(
-                pool_connections=self.max_threads,
-                pool_maxsize=self.max_threads
-            )
-            self.client.session.mount("https://", adapter)
+        self._request_templates = {var_config.name: self._build_request_template(var_config)
+                                   for var_config in self.dataset.variables}
 
-    def _single_toolbox_download(self,
-                                 var_config: object,
-                                 req_dates: object) -> list:
-        """Implements a single download from CDS Toolbox API
+        pool_size = max(self.max_threads, 10)
+        self.client = cds.Client(progress=show_progress,
+                                 session=cds_session(pool_size))
+        self._result_session = result_session(pool_size)
 
-        :param var_config:
-        :param req_dates: the request date
+    def _client(self) -> object:
+        """Gets the calling thread's CDS API client, sharing the pooled session of self.client
+
+        :return: cdsapi.Client for the current thread
         """
+        client = getattr(self._thread_clients, "client", None)
+        if client is None:
+            client = cds.Client(progress=self._show_progress, session=self.client.session)
+            self._thread_clients.client = client
+        return client
 
-        raise RuntimeError("Toolbox downloads are not yet implemented in download-toolbox")
+    def _build_requests(self) -> list:
+        """Groups the levels of each variable into one request per date batch for the CDS API
 
-    def _single_api_download(self,
-                             var_config: object,
-                             req_dates: object) -> list:
-        """Implements a single download from CDS API
+        The toolbox keeps one request per variable and date batch.
+
+        :return: list of (var_configs, req_date_batch) tuples for the CDS API, otherwise as ThreadedDownloader
+        """
+        req_list = super()._build_requests()
+        if self._use_toolbox:
+            return req_list
+
+        grouped = dict()
+        for var_config, req_date_batch in req_list:
+            key = (var_config.prefix if var_config.level else var_config.name,
+                   tuple(req_date_batch))
+            grouped.setdefault(key, (list(), req_date_batch))[0].append(var_config)
+
+        logging.info("Grouped {} requests by level into {} CDS API requests".format(len(req_list), len(grouped)))
+        return [(tuple(var_configs), req_date_batch) for var_configs, req_date_batch in grouped.values()]
+
+    def _already_downloaded(self,
+                            download_path: os.PathLike,
+                            req_dates: object) -> bool:
+        """Whether download_path already holds every requested date, so shouldn't be requested again
+
+        Download paths are named by output group rather than by request, so a file left by an earlier
+        run can hold other dates from the same group and existing alone isn't enough
+
+        :param download_path:
+        :param req_dates: the request dates
+        :return:
+        """
+        if self._force_redownload:
+            return False
+
+        download_stat = stat_or_none(download_path)
+        if download_stat is None or download_stat.st_size == 0:
+            return False
+
+        try:
+            with xr.open_dataset(download_path) as ds:
+                downloaded_dates = set(pd.DatetimeIndex(ds.time.values).date) if "time" in ds.coords else set()
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read {}, downloading again: {}".format(download_path, e))
+            return False
+
+        missing = set(pd.DatetimeIndex(req_dates).date) - downloaded_dates
+        if len(missing) > 0:
+            logging.info("{} lacks {} of the requested dates, downloading again".format(download_path, len(missing)))
+            return False
+
+        logging.info("Skipping {}, already downloaded".format(download_path))
+        return True
+
+    def _download_path(self,
+                       var_config: object,
+                       req_dates: object) -> str:
+        """Output location for a variable and batch of dates
 
         :param var_config:
-        :param req_dates: the request date
+        :param req_dates:
+        :return:
         """
+        return os.path.join(var_config.root_path,
+                            self.dataset.location.name,
+                            os.path.basename(self.dataset.var_filepath(var_config, req_dates)))
 
-        logging.debug("Processing {} dates for {}".format(len(req_dates), var_config))
+    def _build_request_template(self,
+                                var_config: object) -> tuple:
+        """Builds the parts of a CDS API request that don't vary between date batches
+
+        :param var_config:
+        :return: tuple of the CDS dataset name and the retrieve dictionary without dates
+        """
         monthly_request = self.dataset.frequency < Frequency.DAY
         product_type = "reanalysis" if not monthly_request else "monthly_averaged_reanalysis_by_hour_of_day"
 
-        temp_download_path = os.path.join(var_config.root_path,
-                                          self.dataset.location.name,
-                                          "temp.{}".format(os.path.basename(
-                                              self.dataset.var_filepath(var_config, req_dates))))
-        download_path = os.path.join(var_config.root_path,
-                                     self.dataset.location.name,
-                                     os.path.basename(self.dataset.var_filepath(var_config, req_dates)))
-        os.makedirs(os.path.dirname(download_path), exist_ok=True)
-
         retrieve_dict = {
             "product_type": product_type,
             "variable": self.dataset.cdi_map[var_config.prefix],
-            "year": int(req_dates[0].year),
-            "month": list(set(["{:02d}".format(rd.month)
-                               for rd in sorted(req_dates)])),
             # TODO: assumption about the time of day!
             "time": "12:00",
             "format": "netcdf",
@@ -138,45 +304,261 @@ class ERA5Downloader(ThreadedDownloader):
         dataset = "reanalysis-era5-{}{}".format(level_id, "-monthly-means" if monthly_request else "")
 
         if not monthly_request:
-            retrieve_dict["day"] = ["{:02d}".format(d) for d in range(1, 32)]
+            retrieve_dict["day"] = list(request_days)
             # retrieve_dict["time"] = ["{:02d}:00".format(h) for h in range(0, 24)]
 
-        if os.path.exists(temp_download_path):
-            raise DownloaderError("{} already exists, this shouldn't be the case, please consider altering the "
-                                  "time resolution of request to avoid downloaded data clashes".format(temp_download_path))
+        return dataset, retrieve_dict
+
+    def _netcdf_encoding(self,
+                         var_config: object,
+                         da: object) -> dict:
+        """Encoding for writing a downloaded variable, chunked by up to a day of hours across the full grid
+
+        :param var_config:
+        :param da:
+        :return:
+        """
+        encoding = dict(
+            contiguous=False,
+            chunksizes=tuple(min(24, size) if dim == "time" else size
+                             for dim, size in zip(da.dims, da.shape)),
+        )
+
+        # The encoding given to to_netcdf replaces the variable's own, so packing from the source has to be
+        # carried over explicitly, otherwise we don't need more than single precision
+        if "scale_factor" in da.encoding:
+            encoding.update({k: da.encoding[k] for k in packing_keys if k in da.encoding})
+        else:
+            encoding["dtype"] = "float32"
+
+        if self._compress:
+            if self._compression == "zstd":
+                encoding.update(compression="zstd", complevel=self._compress, shuffle=True)
+            else:
+                encoding.update(zlib=True, complevel=self._compress, shuffle=True)
+
+        if self._quantise and var_config.prefix in quant_specs:
+            encoding.update(quant_specs[var_config.prefix])
+        return encoding
+
+    def _single_toolbox_download(self,
+                                 var_config: object,
+                                 req_dates: object) -> list:
+        """Implements a single download from CDS Toolbox API
 
+        :param var_config:
+        :param req_dates: the request date
+        """
+
+        raise RuntimeError("Toolbox downloads are not yet implemented in download-toolbox")
+
+    def _build_retrieve_dict(self,
+                             var_config: object,
+                             req_dates: object) -> tuple:
+        """Completes the request template for a variable with the batch dates
+
+        :param var_config:
+        :param req_dates: the request dates
+        :return: tuple of the CDS dataset name and the retrieve dictionary
+        """
+        req_index = pd.DatetimeIndex(req_dates)
+
+        dataset, retrieve_dict = self._request_templates[var_config.name]
+        retrieve_dict = dict(retrieve_dict,
+                             year=int(req_index.year[0]),
+                             month=[request_months[month - 1] for month in sorted(set(req_index.month))])
+        return dataset, retrieve_dict
+
+    def _retrieve(self,
+                  dataset: str,
+                  retrieve_dict: dict,
+                  target_path: os.PathLike) -> bool:
+        """Retrieves a request from the CDS API to target_path
+
+        :param dataset:
+        :param retrieve_dict:
+        :param target_path:
+        :return: whether the retrieval succeeded
+        """
         try:
-            logging.info("Downloading data for {}...".format(var_config.name))
+            logging.info("Downloading data for {}...".format(retrieve_dict["variable"]))
 
-            self.client.retrieve(
+            result = self._client().retrieve(
                 dataset,
-                retrieve_dict,
-                temp_download_path)
-            logging.info("Download completed: {}".format(temp_download_path))
+                retrieve_dict)
+            location = getattr(result, "location", None)
+
+            if location is None:
+                result.download(target_path)
+            else:
+                # Streamed in large blocks over the retrying result session, rather than cdsapi's small reads
+                with self._result_session.get(location, stream=True, timeout=(10, 600)) as response:
+                    response.raise_for_status()
+                    with atomic_write(target_path) as fh:
+                        written = 0
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            written += fh.write(chunk)
+                        # cdsapi checks this itself, so we must too before the file is moved into place
+                        check_content_length(response, written)
+            logging.info("Download completed: {}".format(target_path))
 
         # cdsapi uses raise Exception in many places, so having a catch-all is appropriate
         except Exception as e:
-            logging.exception("{} not downloaded, look at the problem".format(temp_download_path))
-            self.missing_dates.extend(req_dates)
-            return []
+            logging.exception("{} not downloaded, look at the problem".format(target_path))
+            return False
+        return True
+
+    def _write_variable(self,
+                        var_config: object,
+                        da: object,
+                        attrs: dict,
+                        download_path: os.PathLike):
+        """Writes a retrieved data variable to download_path under the name of var_config
 
-        ds = xr.open_dataset(temp_download_path)
-        ds = ds.rename({list(ds.data_vars)[0]: var_config.name})
-        if 'expver' in ds.coords:
+        :param var_config:
+        :param da: the source data variable
+        :param attrs: global attributes to carry over from the source file
+        :param download_path:
+        """
+        # Only the one data variable is renamed, rather than rebuilding the whole Dataset
+        da = da.rename(var_config.name)
+        if "valid_time" in da.coords:
+            da = da.rename({"valid_time": "time"})
+        if 'expver' in da.coords:
             logging.warning("expvers {} in coordinates, will process out but "
                             "this needs further work: expver needs storing for "
-                            "later overwriting".format(ds.expver))
+                            "later overwriting".format(da.expver))
             # Ref: https://confluence.ecmwf.int/pages/viewpage.action?pageId=173385064
-            ds = ds.sel(expver=1).combine_first(ds.sel(expver=5))
-        ds.to_netcdf(download_path)
-        ds.close()
+            da = da.sel(expver=1).combine_first(da.sel(expver=5))
+        # Written alongside and moved into place, so an existing download_path is always complete
+        with atomic_path(download_path) as partial_path:
+            da.to_dataset().assign_attrs(attrs).to_netcdf(
+                partial_path,
+                encoding={var_config.name: self._netcdf_encoding(var_config, da)})
+
+    def _postprocess_download(self,
+                              var_config: object,
+                              temp_download_path: os.PathLike,
+                              download_path: os.PathLike):
+        """Moves a retrieved file to download_path, naming its variable after var_config
+
+        :param var_config:
+        :param temp_download_path:
+        :param download_path:
+        """
+        with open_time_chunked(temp_download_path) as ds:
+            src_var_name = list(ds.data_vars)[0]
+
+            # Unless the data itself needs reworking, renaming is a header edit and the file can be kept. Renaming
+            # the valid_time coordinate in place with netCDF4 loses its values, so those files are rewritten
+            rewrite = self._compress is not None or self._quantise or \
+                'expver' in ds.coords or "valid_time" in ds.coords
+            if rewrite:
+                self._write_variable(var_config, ds[src_var_name], ds.attrs, download_path)
+
+        if not rewrite:
+            if src_var_name != var_config.name:
+                logging.debug("Renaming {} to {} in place".format(src_var_name, var_config.name))
+                with netCDF4.Dataset(temp_download_path, "a") as nc:
+                    nc.renameVariable(src_var_name, var_config.name)
+            os.replace(temp_download_path, download_path)
+            return
 
         if os.path.exists(temp_download_path):
             logging.debug("Removing {}".format(temp_download_path))
             os.unlink(temp_download_path)
 
+    def _single_api_download(self,
+                             var_config: object,
+                             req_dates: object) -> list:
+        """Implements a single download from CDS API
+
+        :param var_config:
+        :param req_dates: the request date
+        """
+
+        logging.debug("Processing {} dates for {}".format(len(req_dates), var_config))
+
+        download_path = self._download_path(var_config, req_dates)
+        download_dir, download_name = os.path.split(download_path)
+        temp_download_path = os.path.join(download_dir, "temp.{}".format(download_name))
+        _ensure_dir(download_dir)
+
+        if self._already_downloaded(download_path, req_dates):
+            return [download_path]
+
+        dataset, retrieve_dict = self._build_retrieve_dict(var_config, req_dates)
+
+        if os.path.exists(temp_download_path):
+            raise DownloaderError("{} already exists, this shouldn't be the case, please consider altering the "
+                                  "time resolution of request to avoid downloaded data clashes".format(temp_download_path))
+
+        if not self._retrieve(dataset, retrieve_dict, temp_download_path):
+            self.missing_dates.extend(req_dates)
+            return []
+
+        self._postprocess_download(var_config, temp_download_path, download_path)
         return [download_path]
 
+    def _batched_api_download(self,
+                              var_configs: tuple,
+                              req_dates: object) -> list:
+        """Downloads several levels of one variable in a single CDS API request, splitting into a file per level
+
+        :param var_configs: configurations sharing a prefix, differing only by level
+        :param req_dates: the request dates
+        :return: list of the download paths produced
+        """
+        if len(var_configs) == 1:
+            return self._single_api_download(var_configs[0], req_dates)
+
+        download_paths = {var_config.name: self._download_path(var_config, req_dates)
+                          for var_config in var_configs}
+        pending = [var_config for var_config in var_configs
+                   if not self._already_downloaded(download_paths[var_config.name], req_dates)]
+        if len(pending) < 2:
+            return [download_paths[var_config.name] for var_config in var_configs if var_config not in pending] + \
+                [path for var_config in pending for path in self._single_api_download(var_config, req_dates)]
+        var_configs = pending
+
+        for var_config in var_configs:
+            _ensure_dir(os.path.dirname(download_paths[var_config.name]))
+
+        first_path = download_paths[var_configs[0].name]
+        temp_download_path = os.path.join(os.path.dirname(first_path),
+                                          "temp.levels.{}".format(os.path.basename(first_path)))
+
+        dataset, retrieve_dict = self._build_retrieve_dict(var_configs[0], req_dates)
+        retrieve_dict["pressure_level"] = [var_config.level for var_config in var_configs]
+
+        if os.path.exists(temp_download_path):
+            raise DownloaderError("{} already exists, this shouldn't be the case, please consider altering the "
+                                  "time resolution of request to avoid downloaded data clashes".format(temp_download_path))
+
+        if not self._retrieve(dataset, retrieve_dict, temp_download_path):
+            self.missing_dates.extend(req_dates)
+            return []
+
+        try:
+            with open_time_chunked(temp_download_path) as ds:
+                src_var_name = list(ds.data_vars)[0]
+                level_dim = "pressure_level" if "pressure_level" in ds.dims else "level"
+
+                for var_config in var_configs:
+                    logging.debug("Splitting level {} of {} to {}".format(var_config.level,
+                                                                          src_var_name,
+                                                                          var_config.name))
+                    # Selected as a list to keep the single level dimension of a one level request
+                    self._write_variable(var_config,
+                                         ds[src_var_name].sel({level_dim: [int(var_config.level)]}),
+                                         ds.attrs,
+                                         download_paths[var_config.name])
+        finally:
+            # Never left behind, as the next run would refuse to request this batch again
+            logging.debug("Removing {}".format(temp_download_path))
+            os.unlink(temp_download_path)
+        return list(download_paths.values())
+
     def _single_download(self,
                          var_config: object,
                          req_dates: object) -> list:
@@ -187,7 +569,29 @@ class ERA5Downloader(ThreadedDownloader):
 def main():
     args = download_args(choices=["cdsapi", "toolbox"],
                          # TODO: frequency
-                         workers=True)
+                         workers=True,
+                         extra_args=[
+                             (["--compress"], dict(
+                                 type=int,
+                                 choices=range(1, 10),
+                                 default=None,
+                                 help="Compression level for downloaded files"
+                             )),
+                             (["--compression"], dict(
+                                 choices=["zlib", "zstd"],
+                                 default="zlib",
+                                 help="Codec to use with --compress"
+                             )),
+                             (["--force-redownload"], dict(
+                                 action="store_true",
+                                 default=False,
+                                 help="Download again even when the output file already exists"
+                             )),
+                             (["--quantise"], dict(
+                                 action="store_true",
+                                 default=False,
+                                 help="Store variables at reduced precision, see cds.quant_specs"
+                             ))])
 
     logging.info("ERA5 Data Downloading")
 
@@ -208,6 +612,10 @@ def main():
 
     era5 = ERA5Downloader(
         dataset,
+        compress=args.compress,
+        compression=args.compression,
+        force_redownload=args.force_redownload,
+        quantise=args.quantise,
         start_date=args.start_date,
         end_date=args.end_date,
         max_threads=args.workers,
@@ -2,6 +2,7 @@ import logging
 import os
 import requests
 import warnings
+from types import MappingProxyType
 
 import numpy as np
 import pandas as pd
@@ -23,7 +24,7 @@ from download_toolbox.time import Frequency
 
 class CMIP6DatasetConfig(DatasetConfig):
 
-    DAY_TABLE_MAP = {
+    DAY_TABLE_MAP = MappingProxyType({
         'siconca': 'SI{}',
         'tas': '{}',
         'ta': '{}',
@@ -37,9 +38,9 @@ class CMIP6DatasetConfig(DatasetConfig):
         'uas': '{}',
         'vas': '{}',
         'ua': '{}',
-    }
+    })
 
-    MONTH_TABLE_MAP = {
+    MONTH_TABLE_MAP = MappingProxyType({
         'siconca': 'SI{}',
         'tas': '{}',
         'ta': '{}',
@@ -53,9 +54,9 @@ class CMIP6DatasetConfig(DatasetConfig):
         'uas': '{}',
         'vas': '{}',
         'ua': '{}'
-    }
+    })
 
-    GRID_MAP = {
+    GRID_MAP = MappingProxyType({
         'siconca': 'gn',
         'tas': 'gn',
         'ta': 'gn',
@@ -69,7 +70,7 @@ class CMIP6DatasetConfig(DatasetConfig):
         'uas': 'gn',
         'vas': 'gn',
         'ua': 'gn',
-    }
+    })
 
     def __init__(self,
                  source: str,
@@ -99,9 +100,9 @@ class CMIP6DatasetConfig(DatasetConfig):
         if type(self._table_map_override) is not dict:
             raise DataSetError("Table map override should be a dictionary if supplied")
 
-        self._grid_map = CMIP6DatasetConfig.GRID_MAP
-        if default_grid is not None:
-            self._grid_map = {k: default_grid for k in CMIP6DatasetConfig.GRID_MAP.keys()}
+        # Built per instance, so overrides don't leak into the class defaults shared by later configurations
+        self._grid_map = dict(CMIP6DatasetConfig.GRID_MAP) if default_grid is None else \
+            {k: default_grid for k in CMIP6DatasetConfig.GRID_MAP.keys()}
         self._grid_map.update(self._grid_override)
 
         self._table_map = {k: v.format(self.frequency.cmip_id) for k, v in
@@ -7,7 +7,7 @@ import pandas as pd
 from download_toolbox.dataset import DatasetConfig
 from download_toolbox.cli import download_args
 from download_toolbox.download import ThreadedDownloader, DownloaderError
-from download_toolbox.utils import FTPClient
+from download_toolbox.utils import FTPClient, stat_or_none
 from download_toolbox.location import Location
 from download_toolbox.time import Frequency
 
@@ -291,7 +291,10 @@ class SICDownloader(ThreadedDownloader):
             if not os.path.exists(os.path.dirname(destination_path)):
                 os.makedirs(os.path.dirname(destination_path), exist_ok=True)
 
-            if not os.path.exists(destination_path):
+            destination_stat = stat_or_none(destination_path)
+
+            # Empty files are the remnants of failed writes, so we refetch them
+            if destination_stat is None or destination_stat.st_size == 0:
                 try:
                     logging.info("Downloading {}".format(destination_path))
                     self._ftp_client.single_request(source_base,
@@ -43,8 +43,7 @@ class Downloader(metaclass=abc.ABCMeta):
                  **kwargs):
         super().__init__()
 
-        self._dates = [pd.to_datetime(date).date() for date in
-                       pd.date_range(start_date, end_date, freq=dataset.frequency.freq)]
+        self._dates = list(pd.date_range(start_date, end_date, freq=dataset.frequency.freq).date)
         self._delete = delete_tempfiles
         self._download = download
         self._drop_vars = list() if drop_vars is None else drop_vars
@@ -168,17 +167,7 @@ class ThreadedDownloader(Downloader, metaclass=ABCMeta):
         logging.info("Building request(s), downloading and averaging "
                      "from {} API".format(self.dataset.identifier.upper()))
 
-        req_list = list()
-
-        for var_config in self.dataset.variables:
-            dates = self.dataset.filter_extant_data(var_config, self.dates)
-
-            for req_date_batch in batch_requested_dates(dates=dates, attribute=self.request_frequency.attribute):
-                logging.info("Processing single download for {} with {} dates".
-                             format(var_config.name, len(req_date_batch)))
-
-                req_list.append((var_config, req_date_batch))
-
+        req_list = self._build_requests()
         max_workers = min(len(req_list), self._max_threads)
 
         if max_workers > 0:
@@ -207,6 +196,23 @@ class ThreadedDownloader(Downloader, metaclass=ABCMeta):
 
         logging.info("{} files downloaded".format(len(self._files_downloaded)))
 
+    def _build_requests(self) -> list:
+        """Batches the dates for each variable into the argument tuples for download_method
+
+        :return: list of (var_config, req_date_batch) tuples
+        """
+        req_list = list()
+
+        for var_config in self.dataset.variables:
+            dates = self.dataset.filter_extant_data(var_config, self.dates)
+
+            for req_date_batch in batch_requested_dates(dates=dates, attribute=self.request_frequency.attribute):
+                logging.info("Processing single download for {} with {} dates".
+                             format(var_config.name, len(req_date_batch)))
+
+                req_list.append((var_config, req_date_batch))
+        return req_list
+
     @property
     def max_threads(self):
         return self._max_threads
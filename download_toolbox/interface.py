@@ -56,7 +56,7 @@ def get_dataset_config_implementation(config: os.PathLike):
 
     logging.debug("Retrieving implementations details from {}".format(config))
 
-    with open(config) as fh:
+    with open(config, "rb") as fh:
         data = fh.read()
 
     cfg = orjson.loads(data)
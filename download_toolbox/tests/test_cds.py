@@ -0,0 +1,149 @@
+"""Tests for the ERA5 downloader, run against a fake CDS API client"""
+
+import datetime as dt
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip("cdsapi")
+
+from download_toolbox.data import cds as cds_module  # noqa: E402
+from download_toolbox.data.cds import ERA5DatasetConfig, ERA5Downloader  # noqa: E402
+from download_toolbox.location import Location  # noqa: E402
+from download_toolbox.time import Frequency  # noqa: E402
+
+
+@pytest.fixture
+def cds_requests(monkeypatch):
+    """Replace cdsapi.Client with one that returns synthetic data as the newer CDS formats it
+
+    Every request made is recorded in the returned list
+    """
+    requests = []
+
+    class FakeResult:
+        def __init__(self, ds):
+            self._ds = ds
+
+        def download(self, target):
+            self._ds.to_netcdf(target)
+
+    class FakeClient:
+        def __init__(self, *args, session=None, **kwargs):
+            self.session = session
+
+        def retrieve(self, dataset, request, target=None):
+            requests.append((dataset, request))
+            times = [pd.Timestamp(request["year"], int(month), int(day), 12)
+                     for month in request["month"]
+                     for day in request["day"]
+                     if int(day) <= pd.Timestamp(request["year"], int(month), 1).days_in_month]
+            dims = ("valid_time", "latitude", "longitude")
+            coords = dict(valid_time=times, latitude=[1.0, 0.0], longitude=[0.0, 1.0, 2.0])
+            shape = (len(times), 2, 3)
+
+            if "pressure_level" in request:
+                dims = ("valid_time", "pressure_level", "latitude", "longitude")
+                coords["pressure_level"] = [int(level) for level in request["pressure_level"]]
+                shape = (len(times), len(coords["pressure_level"]), 2, 3)
+
+            data = np.arange(np.prod(shape), dtype="float32").reshape(shape)
+            return FakeResult(xr.Dataset({"z": (dims, data)}, coords=coords))
+
+    monkeypatch.setattr(cds_module.cds, "Client", FakeClient)
+    return requests
+
+
+def era5_downloader(base_path, var_names, levels, start_date, end_date, **kwargs):
+    dataset = ERA5DatasetConfig(base_path=str(base_path),
+                                levels=levels,
+                                location=Location(name="hemi.north", north=True),
+                                var_names=var_names,
+                                frequency=Frequency.DAY,
+                                output_group_by=Frequency.YEAR)
+    return ERA5Downloader(dataset,
+                          start_date=start_date,
+                          end_date=end_date,
+                          max_threads=1,
+                          request_frequency=Frequency.YEAR,
+                          **kwargs)
+
+
+def test_valid_time_download_is_readable(tmp_path, cds_requests):
+    """Files from the newer CDS come out with a decodable time coordinate, not valid_time"""
+    era5 = era5_downloader(tmp_path, ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 1, 31))
+    era5.download()
+
+    assert len(era5.files_downloaded) == 1
+    with xr.open_dataset(era5.files_downloaded[0]) as ds:
+        assert "tas" in ds.data_vars
+        assert "valid_time" not in ds.variables
+        assert list(pd.DatetimeIndex(ds.time.values).date) == \
+            list(pd.date_range("2020-01-01", "2020-01-31").date)
+
+
+def test_batched_levels_on_empty_tree(tmp_path, cds_requests):
+    """Levels fetched in one request are each written out, with no temporary file left behind"""
+    era5 = era5_downloader(tmp_path, ["zg"], [[250, 500]], dt.date(2020, 1, 1), dt.date(2020, 1, 31))
+    era5.download()
+
+    assert len(cds_requests) == 1
+    assert sorted(cds_requests[0][1]["pressure_level"]) == [250, 500]
+    assert len(era5.files_downloaded) == 2
+
+    for path, level in zip(sorted(era5.files_downloaded), ["250", "500"]):
+        assert "zg{}".format(level) in path
+        with xr.open_dataset(path) as ds:
+            assert list(ds.data_vars) == ["zg{}".format(level)]
+            assert ds.time.size == 31
+
+    assert glob.glob(os.path.join(str(tmp_path), "**", "temp.*"), recursive=True) == []
+
+
+def test_cdi_map_per_instance(tmp_path, cds_requests):
+    """Overrides and later changes to one configuration's CDI map reach neither the defaults nor other configurations"""
+    first = era5_downloader(tmp_path / "first", ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 1, 31))
+    second = era5_downloader(tmp_path / "second", ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 1, 31))
+
+    with pytest.raises(TypeError):
+        ERA5DatasetConfig.CDI_MAP["tas"] = "skin_temperature"
+
+    first.dataset.cdi_map["tas"] = "skin_temperature"
+    assert ERA5DatasetConfig.CDI_MAP["tas"] == "2m_temperature"
+    assert second.dataset.cdi_map["tas"] == "2m_temperature"
+
+    overridden = ERA5DatasetConfig(base_path=str(tmp_path / "third"),
+                                   cdi_map=dict(tas="skin_temperature"),
+                                   levels=[None],
+                                   location=Location(name="hemi.north", north=True),
+                                   var_names=["tas"])
+    assert overridden.cdi_map["tas"] == "skin_temperature"
+    assert ERA5DatasetConfig.CDI_MAP["tas"] == "2m_temperature"
+
+
+def test_existing_download_skipped_only_when_covering_dates(tmp_path, cds_requests):
+    """A year file is reused only while it holds every requested date"""
+    era5 = era5_downloader(tmp_path, ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 3, 31))
+    era5.download()
+    assert len(cds_requests) == 1
+
+    era5 = era5_downloader(tmp_path, ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 3, 31))
+    era5.download()
+    assert len(cds_requests) == 1
+    assert len(era5.files_downloaded) == 1
+
+    era5 = era5_downloader(tmp_path, ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 4, 30))
+    era5.download()
+    assert len(cds_requests) == 2
+    assert cds_requests[-1][1]["month"] == ["01", "02", "03", "04"]
+    with xr.open_dataset(era5.files_downloaded[0]) as ds:
+        assert pd.DatetimeIndex(ds.time.values).max().date() == dt.date(2020, 4, 30)
+
+    era5 = era5_downloader(tmp_path, ["tas"], [None], dt.date(2020, 1, 1), dt.date(2020, 4, 30),
+                           force_redownload=True)
+    era5.download()
+    assert len(cds_requests) == 3
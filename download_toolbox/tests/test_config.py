@@ -0,0 +1,49 @@
+"""Tests for Configuration rendering"""
+
+import os
+
+import orjson
+
+from download_toolbox.config import Configuration
+
+
+class Owner(object):
+    def __init__(self, **config):
+        self.config = config
+
+    def get_config(self):
+        return self.config
+
+
+def test_render_twice_skips_second_write(tmp_path):
+    """An unchanged configuration isn't rewritten; being replaced atomically, a rewrite would change the inode"""
+    owner = Owner(identifier="era5", levels=[None, [250, 500]])
+    configuration = Configuration(directory=str(tmp_path), identifier="era5", config_type="dataset")
+
+    output_file = configuration.render(owner)
+    inode = os.stat(output_file).st_ino
+    with open(output_file, "rb") as fh:
+        assert orjson.loads(fh.read())["data"] == owner.config
+
+    assert configuration.render(owner) == output_file
+    assert os.stat(output_file).st_ino == inode
+
+    # Loaded from disk, an identical render is also skipped
+    reloaded = Configuration(directory=str(tmp_path), identifier="era5", config_type="dataset")
+    reloaded.render(owner)
+    assert os.stat(output_file).st_ino == inode
+
+
+def test_render_changed_rewrites(tmp_path):
+    owner = Owner(identifier="era5")
+    configuration = Configuration(directory=str(tmp_path), identifier="era5", config_type="dataset")
+
+    output_file = configuration.render(owner)
+    inode = os.stat(output_file).st_ino
+
+    owner.config["identifier"] = "era5.changed"
+    configuration.render(owner)
+    assert os.stat(output_file).st_ino != inode
+    with open(output_file, "rb") as fh:
+        assert orjson.loads(fh.read())["data"]["identifier"] == "era5.changed"
+    assert os.listdir(str(tmp_path)) == [os.path.basename(output_file)]
@@ -0,0 +1,51 @@
+"""Tests for the CMIP6 configuration and downloader that need no ESGF access"""
+
+import datetime as dt
+
+import pytest
+
+pytest.importorskip("pyesgf")
+
+from download_toolbox.data.esgf import CMIP6DatasetConfig, CMIP6LegacyDownloader  # noqa: E402
+from download_toolbox.location import Location  # noqa: E402
+from download_toolbox.time import Frequency  # noqa: E402
+
+
+def cmip6_downloader(base_path, **kwargs):
+    dataset = CMIP6DatasetConfig(source="MRI-ESM2-0",
+                                 member="r1i1p1f1",
+                                 base_path=str(base_path),
+                                 levels=[None],
+                                 location=Location(name="hemi.north", north=True),
+                                 var_names=["tas"],
+                                 frequency=Frequency.DAY,
+                                 **kwargs)
+    return CMIP6LegacyDownloader(dataset,
+                                 start_date=dt.date(2000, 1, 1),
+                                 end_date=dt.date(2000, 12, 31),
+                                 max_threads=1)
+
+
+def test_grid_map_per_instance(tmp_path):
+    """Overrides and later changes to one configuration's grid map reach neither the defaults nor other configurations"""
+    first = cmip6_downloader(tmp_path / "first", grid_override=dict(tas="gr"))
+    second = cmip6_downloader(tmp_path / "second")
+
+    with pytest.raises(TypeError):
+        CMIP6DatasetConfig.GRID_MAP["tas"] = "gr"
+
+    assert first.dataset.grid_map["tas"] == "gr"
+    assert second.dataset.grid_map["tas"] == "gn"
+
+    first.dataset.grid_map["tos"] = "gn"
+    assert CMIP6DatasetConfig.GRID_MAP["tos"] == "gr"
+    assert second.dataset.grid_map["tos"] == "gr"
+
+
+def test_default_grid_per_instance(tmp_path):
+    """A default grid only applies to the configuration it was given to"""
+    first = cmip6_downloader(tmp_path / "first", default_grid="gr1")
+    second = cmip6_downloader(tmp_path / "second")
+
+    assert set(first.dataset.grid_map.values()) == {"gr1"}
+    assert second.dataset.grid_map == dict(CMIP6DatasetConfig.GRID_MAP)
@@ -0,0 +1,129 @@
+"""Tests for HTTPClient, run against a local HTTP server"""
+
+import email.utils
+import http.server
+import os
+import threading
+
+import pytest
+
+from download_toolbox.utils import ClientError, HTTPClient
+
+BODY = b"sea ice concentration" * 100
+ETAG = '"v1"'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, dict(self.headers)))
+
+        if self.path == "/files/etag.bin":
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+        elif self.path == "/files/dated.bin":
+            since = self.headers.get("If-Modified-Since")
+            if since is not None and email.utils.parsedate_to_datetime(since).year >= 2020:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Last-Modified", "Wed, 01 Jan 2020 00:00:00 GMT")
+        elif self.path == "/files/truncated.bin":
+            # Announce far more than is sent, then drop the connection
+            self.send_response(200)
+            self.send_header("Content-Length", "3000000")
+            self.end_headers()
+            self.wfile.write(BODY[:1000])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_host():
+    Handler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_etag_round_trip(http_host, tmp_path):
+    """The ETag is stored beside the download and sent back, with a 304 leaving the file alone"""
+    destination = str(tmp_path / "etag.bin")
+    client = HTTPClient(http_host, source_base="files", conditional=True)
+
+    assert client.single_request("etag.bin", destination) is True
+    with open(destination, "rb") as fh:
+        assert fh.read() == BODY
+    with open("{}.etag".format(destination)) as fh:
+        assert fh.read() == ETAG
+
+    mtime = os.stat(destination).st_mtime_ns
+    assert client.single_request("etag.bin", destination) is False
+    assert Handler.requests[-1][1].get("If-None-Match") == ETAG
+    assert os.stat(destination).st_mtime_ns == mtime
+
+
+def test_not_modified_since(http_host, tmp_path):
+    """Without a stored ETag the destination's mtime is used to revalidate"""
+    destination = str(tmp_path / "dated.bin")
+    client = HTTPClient(http_host, source_base="files", conditional=True)
+
+    assert client.single_request("dated.bin", destination) is True
+    assert "If-Modified-Since" not in Handler.requests[-1][1]
+    assert not os.path.exists("{}.etag".format(destination))
+
+    assert client.single_request("dated.bin", destination) is False
+    assert "If-Modified-Since" in Handler.requests[-1][1]
+    with open(destination, "rb") as fh:
+        assert fh.read() == BODY
+
+
+def test_unconditional_refetches(http_host, tmp_path):
+    """Without revalidation an existing destination is requested and written again"""
+    destination = str(tmp_path / "etag.bin")
+    client = HTTPClient(http_host, source_base="files")
+
+    assert client.single_request("etag.bin", destination) is True
+    assert client.single_request("etag.bin", destination) is True
+    assert "If-None-Match" not in Handler.requests[-1][1]
+    assert not os.path.exists("{}.etag".format(destination))
+
+
+def test_truncated_download_discarded(http_host, tmp_path):
+    """A body shorter than its Content-Length raises and leaves nothing at, or beside, the destination"""
+    destination = str(tmp_path / "truncated.bin")
+    client = HTTPClient(http_host, source_base="files", retries=0)
+
+    with pytest.raises(ClientError):
+        client.single_request("truncated.bin", destination)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_unsuccessful_response(http_host, tmp_path):
+    destination = str(tmp_path / "missing.bin")
+    client = HTTPClient(http_host, source_base="files")
+
+    with pytest.raises(ClientError):
+        client.single_request("missing.bin", destination)
+    assert os.listdir(str(tmp_path)) == []
@@ -1,15 +1,24 @@
 import datetime as dt
+import email.utils
 import ftplib
 import logging
+import os
+import socket
 import subprocess as sp
 import threading
+from contextlib import contextmanager
 from ftplib import FTP
 
 from functools import wraps
 
 import dask
 import requests
+import requests.adapters
 from dask.distributed import Client, LocalCluster
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+suppressed_loggers = frozenset({"cdsapi", "matplotlib", "requests", "urllib3"})
 
 
 def run_command(command: str, dry: bool = False):
@@ -36,6 +45,68 @@ def run_command(command: str, dry: bool = False):
     return ret
 
 
+@contextmanager
+def atomic_path(destination_path: object):
+    """Yield a temporary path to write to that only replaces destination_path once fully written
+
+    Output goes to a process specific .part file, which is renamed over the destination on
+    success and removed on failure, so an interrupted write never looks like a complete file
+
+    :param destination_path:
+    """
+    temporary_path = "{}.part.{}".format(destination_path, os.getpid())
+
+    try:
+        yield temporary_path
+        os.replace(temporary_path, destination_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+        raise
+
+
+@contextmanager
+def atomic_write(destination_path: object):
+    """Yield a binary file handle that only replaces destination_path once fully written
+
+    :param destination_path:
+    """
+    with atomic_path(destination_path) as temporary_path:
+        with open(temporary_path, "wb") as fh:
+            yield fh
+
+
+def stat_or_none(path: object) -> object:
+    """Stat a path, returning None rather than raising if it doesn't exist
+
+    :param path:
+    :return: the os.stat_result for the path, or None
+    """
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def check_content_length(response: object, written: int):
+    """Raise if fewer bytes were received than the response announced
+
+    A connection dropped part way through a body ends iter_content cleanly without this check, so
+    call it before the destination is replaced. Encoded bodies are decoded by iter_content, so their
+    length can't be compared
+
+    :param response: the requests response being streamed
+    :param written: the number of bytes written from it
+    """
+    if "Content-Length" not in response.headers or \
+            response.headers.get("Content-Encoding", "identity") != "identity":
+        return
+
+    expected = int(response.headers["Content-Length"])
+    if written != expected:
+        raise ClientError("Received {} of {} bytes from {}".format(written, expected, response.url))
+
+
 def setup_logging(func,
                   log_format="[%(asctime)-17s :%(levelname)-8s] - %(message)s"):
     @wraps(func)
@@ -54,9 +125,8 @@ def setup_logging(func,
         # FIXME: something is interrupting the root logger setup
         logging.getLogger().setLevel(level)
         # TODO: better way of handling these on a case by case basis
-        logging.getLogger("cdsapi").setLevel(logging.WARNING)
-        logging.getLogger("requests").setLevel(logging.WARNING)
-        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        for logger_name in suppressed_loggers:
+            logging.getLogger(logger_name).setLevel(logging.WARNING)
         return parsed_args
     return wrapper
 
@@ -150,41 +220,147 @@ class FTPClient(object):
             raise ClientError("FTP error, possibly missing directory {}: {}".format(source_dir, e))
 
         logging.debug("FTP Attempting to retrieve to {} from {}".format(destination_path, ftp_files[0]))
-        with open(destination_path, "wb") as fh:
-            ftp_connection.retrbinary("RETR {}".format(ftp_files[0]), fh.write)
+        try:
+            with atomic_write(destination_path) as fh:
+                ftp_connection.retrbinary("RETR {}".format(ftp_files[0]), fh.write)
+        except ftplib.all_errors as e:
+            raise ClientError("FTP error retrieving {}: {}".format(ftp_files[0], e))
+
+
+class SocketOptionsAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter whose pooled connections can be given fixed socket buffer sizes
+
+    By default only urllib3's default socket options (TCP_NODELAY) are used. Setting SO_RCVBUF
+    disables the kernel's receive buffer autotuning on Linux, which usually grows beyond any
+    fixed size we'd choose on high latency links, so buffer_size should only be set where a
+    measurement shows it helps
+
+    :param buffer_size: optional SO_RCVBUF / SO_SNDBUF size in bytes
+    """
+    def __init__(self,
+                 *args,
+                 buffer_size: int = None,
+                 **kwargs):
+        self._socket_options = list(HTTPConnection.default_socket_options)
+        if buffer_size is not None:
+            self._socket_options += [
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size),
+                (socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size),
+            ]
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self._socket_options)
+        super().init_poolmanager(*args, **kwargs)
 
 
 class HTTPClient(object):
+    """Makes requests against a single host, reusing connections via a keep-alive session
+
+    :param host:
+    :param source_base:
+    :param conditional: revalidate existing destinations with If-None-Match / If-Modified-Since
+    :param pool_maxsize: the number of connections to keep open, match this to the thread count
+    :param retries: the number of retries for failed connections or server errors
+    :param timeout: the default (connect, read) timeout for requests
+    """
     def __init__(self,
                  host: str,
                  *args,
                  source_base: object = None,
+                 conditional: bool = False,
+                 pool_maxsize: int = 16,
+                 retries: int = 3,
+                 timeout: object = (5, 60),
                  **kwargs):
         super().__init__(*args, **kwargs)
 
+        self._conditional = conditional
         self._host = host
         self._source_base = source_base
+        self._timeout = timeout
+
+        self._session = requests.Session()
+        adapter = SocketOptionsAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            # The final failed response is returned rather than raised, so it reaches the status check
+            max_retries=Retry(total=retries,
+                              backoff_factor=0.3,
+                              status_forcelist=(500, 502, 503, 504),
+                              raise_on_status=False),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def _conditional_headers(self,
+                             destination_path: object) -> dict:
+        """Validators for an existing destination, preferring a stored ETag over the file mtime
+
+        :param destination_path:
+        :return:
+        """
+        destination_stat = stat_or_none(destination_path)
+        # Nothing worth keeping, so fetch unconditionally
+        if destination_stat is None or destination_stat.st_size == 0:
+            return dict()
+
+        try:
+            with open("{}.etag".format(destination_path), "r") as fh:
+                return {"If-None-Match": fh.read().strip()}
+        except FileNotFoundError:
+            return {"If-Modified-Since": email.utils.formatdate(destination_stat.st_mtime, usegmt=True)}
 
     def single_request(self,
                        source: object,
                        destination_path: object,
                        method: str = "get",
-                       request_options: dict = None):
-        request_options = dict() if request_options is None else request_options
+                       request_options: dict = None) -> bool:
+        """Request source and write the response to destination_path
+
+        :param source:
+        :param destination_path:
+        :param method:
+        :param request_options:
+        :return: False if a conditional request found the destination unmodified, otherwise True
+        """
+        request_options = {"stream": True,
+                           "timeout": self._timeout,
+                           **(dict() if request_options is None else request_options)}
         source_url = "/".join([self._host, self._source_base, source])
 
+        if self._conditional:
+            request_options["headers"] = {**self._conditional_headers(destination_path),
+                                          **request_options.get("headers", dict())}
+
         try:
             logging.debug("{}-ing {} with {}".format(method, source_url, request_options))
-            response = getattr(requests, method)(source_url, **request_options)
+            response = self._session.request(method, source_url, **request_options)
         except requests.exceptions.RequestException as e:
             raise ClientError("HTTP error {}: {}".format(source_url, e))
 
-        if hasattr(response, "status_code") and response.status_code == 200:
-            logging.debug("Attempting to output response content to {}".format(destination_path))
-            with open(destination_path, "wb") as fh:
-                fh.write(response.content)
-        else:
-            raise ClientError("HTTP response was not successful, writing nothing: {}".format(response.status_code))
+        with response:
+            if self._conditional and getattr(response, "status_code", None) == 304:
+                logging.debug("{} is not modified, keeping {}".format(source_url, destination_path))
+                return False
+            elif hasattr(response, "status_code") and response.status_code == 200:
+                logging.debug("Attempting to output response content to {}".format(destination_path))
+                try:
+                    with atomic_write(destination_path) as fh:
+                        written = 0
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            written += fh.write(chunk)
+                        check_content_length(response, written)
+                except requests.exceptions.RequestException as e:
+                    raise ClientError("HTTP error reading {}: {}".format(source_url, e))
+
+                if self._conditional and "ETag" in response.headers:
+                    with open("{}.etag".format(destination_path), "w") as fh:
+                        fh.write(response.headers["ETag"])
+                return True
+            else:
+                raise ClientError("HTTP response was not successful, writing nothing: {}".
+                                  format(response.status_code))
 
 
 class ClientError(RuntimeError):